@@ -3,68 +3,233 @@ Voice Agent Email Actions — FastAPI Backend
 Enables voice AI agents to send emails during and after calls.
 
 Run: uvicorn main:app --reload --port 8000
+ or: python main.py  (production settings; DEBUG=1 for reload)
 """
 
-import json
+import asyncio
+import functools
+import logging
 import os
 import re
-import smtplib
+import string
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Union
 
+import aiosmtplib
+import anyio.to_thread
+import orjson
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request
+from fastapi import BackgroundTasks, FastAPI, Request, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse
 
 load_dotenv()
 
 GMAIL_USER = os.getenv("GMAIL_USER")
 GMAIL_APP_PASSWORD = os.getenv("GMAIL_APP_PASSWORD")
 COMPANY_NAME = os.getenv("COMPANY_NAME", "Boca Raton Health Insurers")
+DEBUG = os.getenv("DEBUG", "").lower() in ("1", "true", "yes")
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "200"))
+STATIC_CACHE_CONTROL = os.getenv("STATIC_CACHE_CONTROL", "public, max-age=86400")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG" if DEBUG else "INFO").upper()
+if not isinstance(logging.getLevelName(LOG_LEVEL), int):
+    LOG_LEVEL = "INFO"
+
+# Configure only this module's logger so third-party INFO logs stay quiet.
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+    logger.addHandler(_log_handler)
+    logger.propagate = False
 
 BASE_DIR = Path(__file__).resolve().parent
 TEMPLATES_DIR = BASE_DIR / "templates"
 
-app = FastAPI(title="Voice Agent Email Actions", version="1.0.0")
-app.mount("/static", StaticFiles(directory=BASE_DIR / "static"), name="static")
+# The lookbehind only lets a match start at the beginning of a local-part run,
+# so a long run without an '@' is scanned once instead of from every offset.
+_EMAIL_RE = re.compile(
+    r'(?<![\w.%+-])[\w.%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}', re.ASCII
+)
+
+_smtp_lock = asyncio.Lock()
+_smtp_client: Optional[aiosmtplib.SMTP] = None
+
+
+async def _close_smtp() -> None:
+    """Close the cached SMTP connection, if any."""
+    global _smtp_client
+    if _smtp_client is None:
+        return
+    try:
+        await _smtp_client.quit()
+    except (aiosmtplib.SMTPException, OSError):
+        _smtp_client.close()
+    _smtp_client = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Size the worker thread pool on startup; release SMTP on shutdown."""
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = THREADPOOL_SIZE
+    yield
+    async with _smtp_lock:
+        await _close_smtp()
+
 
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that lets browsers cache assets instead of refetching them."""
 
+    def __init__(self, *args, cache_control: str, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_control = cache_control
+
+    def file_response(self, *args, **kwargs) -> Response:
+        response = super().file_response(*args, **kwargs)
+        response.headers.setdefault("cache-control", self.cache_control)
+        return response
+
+
+app = FastAPI(
+    title="Voice Agent Email Actions",
+    version="1.0.0",
+    lifespan=lifespan,
+)
+app.mount(
+    "/static",
+    CachedStaticFiles(directory=BASE_DIR / "static", cache_control=STATIC_CACHE_CONTROL),
+    name="static",
+)
+
+
+@functools.lru_cache(maxsize=None)
 def load_template(name: str) -> str:
-    """Load an HTML template from the templates directory."""
+    """Load an HTML template from the templates directory (cached)."""
     template_path = TEMPLATES_DIR / name
     return template_path.read_text(encoding="utf-8")
 
 
-def send_email(to_email: str, subject: str, html_content: str) -> bool:
-    """Send an HTML email via Gmail SMTP."""
-    if not GMAIL_USER or not GMAIL_APP_PASSWORD:
-        print("ERROR: Missing Gmail credentials in .env")
-        return False
+def compile_template(html: str) -> tuple[tuple[str, Optional[str]], ...]:
+    """
+    Split a {placeholder} template into (literal, field) pairs once.
+    Only plain {name} fields are supported; anything else raises ValueError.
+    """
+    parts = []
+    for literal, field, spec, conversion in string.Formatter().parse(html):
+        if field is not None and (spec or conversion or not field.isidentifier()):
+            raise ValueError(
+                f"Unsupported template field {field!r}: only plain {{name}} is allowed"
+            )
+        parts.append((literal, field))
+    return tuple(parts)
+
+
+def render_template(parts: tuple[tuple[str, Optional[str]], ...], **fields) -> str:
+    """Fill a compiled template without re-scanning the HTML."""
+    return "".join(
+        literal if field is None else literal + str(fields[field])
+        for literal, field in parts
+    )
+
+
+_TEMPLATES: dict[str, str] = {
+    name: load_template(name)
+    for name in ("info_email.html", "followup_email.html")
+}
+_INFO_PARTS = compile_template(_TEMPLATES["info_email.html"])
+_FOLLOWUP_HTML = render_template(
+    compile_template(_TEMPLATES["followup_email.html"]),
+    company_name=COMPANY_NAME,
+)
+# The follow-up body never changes, so encode its MIME part only once.
+_FOLLOWUP_MIMETEXT = MIMEText(_FOLLOWUP_HTML, "html")
+_FOLLOWUP_SUBJECT = f"Your Next Steps — {COMPANY_NAME}"
+
+
+def _smtp_configured() -> bool:
+    """Check that Gmail credentials are set, logging when they are not."""
+    if GMAIL_USER and GMAIL_APP_PASSWORD:
+        return True
+    logger.error("Missing Gmail credentials in .env")
+    return False
+
+
+async def _get_smtp() -> aiosmtplib.SMTP:
+    """Return an authenticated Gmail SMTP connection, reconnecting if stale."""
+    global _smtp_client
+    if _smtp_client is not None:
+        try:
+            await _smtp_client.noop()
+            return _smtp_client
+        except (aiosmtplib.SMTPException, OSError):
+            await _close_smtp()
     
+    server = aiosmtplib.SMTP(hostname="smtp.gmail.com", port=587, start_tls=False)
+    await server.connect()
     try:
-        msg = MIMEMultipart("alternative")
-        msg["From"] = GMAIL_USER
-        msg["To"] = to_email
-        msg["Subject"] = subject
-        msg.attach(MIMEText(html_content, "html"))
-        
-        with smtplib.SMTP("smtp.gmail.com", 587) as server:
-            server.starttls()
-            server.login(GMAIL_USER, GMAIL_APP_PASSWORD)
-            server.sendmail(GMAIL_USER, to_email, msg.as_string())
-        
-        print(f"Email sent: {to_email} — {subject}")
-        return True
-        
-    except smtplib.SMTPAuthenticationError:
-        print("ERROR: Gmail authentication failed")
-        return False
-    except Exception as e:
-        print(f"ERROR: {e}")
+        await server.starttls()
+        await server.login(GMAIL_USER, GMAIL_APP_PASSWORD)
+    except Exception:
+        server.close()
+        raise
+    _smtp_client = server
+    return server
+
+
+async def send_email(
+    to_email: str, subject: str, html_content: Union[str, MIMEText]
+) -> bool:
+    """
+    Send an HTML email via Gmail SMTP over the shared connection.
+    html_content may be a prebuilt MIMEText part to skip re-encoding the body.
+    """
+    if not _smtp_configured():
         return False
+    
+    async with _smtp_lock:
+        try:
+            msg = MIMEMultipart("alternative")
+            msg["From"] = GMAIL_USER
+            msg["To"] = to_email
+            msg["Subject"] = subject
+            if isinstance(html_content, str):
+                html_content = MIMEText(html_content, "html")
+            msg.attach(html_content)
+            
+            try:
+                server = await _get_smtp()
+                await server.send_message(msg, sender=GMAIL_USER, recipients=[to_email])
+            except aiosmtplib.SMTPServerDisconnected:
+                await _close_smtp()
+                server = await _get_smtp()
+                await server.send_message(msg, sender=GMAIL_USER, recipients=[to_email])
+            
+            logger.info("Email sent: %s — %s", to_email, subject)
+            return True
+            
+        except aiosmtplib.SMTPAuthenticationError:
+            logger.error("Gmail authentication failed")
+            await _close_smtp()
+            return False
+        except Exception as e:
+            logger.error("Send failed: %s", e)
+            await _close_smtp()
+            return False
+
+
+def _log_payload(route: str, payload) -> None:
+    """Pretty-print a request payload, only when debug logging is on."""
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "POST %s payload: %s",
+            route,
+            orjson.dumps(payload, option=orjson.OPT_INDENT_2).decode(),
+        )
 
 
 def extract_tool_call_args(payload: dict) -> Optional[dict]:
@@ -75,39 +240,69 @@ def extract_tool_call_args(payload: dict) -> Optional[dict]:
         
         if tool_calls:
             args = tool_calls[0].get("function", {}).get("arguments", {})
-            return json.loads(args) if isinstance(args, str) else args
+            return orjson.loads(args) if isinstance(args, str) else args
     except Exception as e:
-        print(f"Parse error: {e}")
+        logger.warning("Parse error: %s", e)
     
     return None
 
 
+@functools.lru_cache(maxsize=32)
+def _cached_extract_email(text: str) -> Optional[str]:
+    """
+    Regex search memoized per exact string, for retried webhooks.
+    The cache holds full transcript text (caller PII), so keep it small.
+    """
+    return m.group(0) if (m := _EMAIL_RE.search(text)) else None
+
+
 def extract_email_from_text(text: str) -> Optional[str]:
     """Find email address in text using regex."""
     if not text:
         return None
-    match = re.search(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}', text)
-    return match.group(0) if match else None
+    return _cached_extract_email(text)
+
+
+def _find_email_in_obj(obj) -> Optional[str]:
+    """Find the first email address in any string value of a JSON object."""
+    if isinstance(obj, str):
+        return m.group(0) if (m := _EMAIL_RE.search(obj)) else None
+    if isinstance(obj, dict):
+        obj = obj.values()
+    elif not isinstance(obj, list):
+        return None
+    for item in obj:
+        if found := _find_email_in_obj(item):
+            return found
+    return None
+
+
+_INDEX_BYTES = (TEMPLATES_DIR / "index.html").read_bytes()
+_INDEX_HEADERS = {
+    "content-type": "text/html; charset=utf-8",
+    "cache-control": "public, max-age=60",
+}
 
 
 @app.get("/", response_class=HTMLResponse)
 async def landing_page():
     """Serve the landing page."""
-    return load_template("index.html")
+    return Response(content=_INDEX_BYTES, headers=_INDEX_HEADERS)
 
 
 @app.post("/send-specific-email")
-async def send_specific_email(request: Request):
+async def send_specific_email(request: Request, background: BackgroundTasks):
     """
     Mid-call tool endpoint.
     Vapi calls this when the user requests documents or information.
     """
     try:
-        payload = await request.json()
-    except:
+        payload = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
         return {"success": False, "message": "Invalid JSON"}
     
-    print(f"POST /send-specific-email")
+    logger.info("POST /send-specific-email")
+    _log_payload("/send-specific-email", payload)
     
     args = extract_tool_call_args(payload) or payload
     
@@ -120,77 +315,102 @@ async def send_specific_email(request: Request):
     
     subject = f"Your {topic} — {COMPANY_NAME}"
     
-    html_content = load_template("info_email.html").format(
+    html_content = render_template(
+        _INFO_PARTS,
         company_name=COMPANY_NAME,
         user_name=user_name,
         topic=topic
     )
     
-    if send_email(user_email, subject, html_content):
-        return {"success": True, "message": f"Email sent to {user_email}"}
-    return {"success": False, "message": "Failed to send email"}
+    if not _smtp_configured():
+        return {"success": False, "message": "Failed to send email"}
+    
+    # Reply to Vapi right away; the SMTP round trip happens after the response.
+    background.add_task(send_email, user_email, subject, html_content)
+    return {"success": True, "message": f"Email queued for {user_email}"}
 
 
 @app.post("/vapi-webhook")
-async def vapi_webhook(request: Request):
+async def vapi_webhook(request: Request, background: BackgroundTasks):
     """
     Post-call webhook endpoint.
     Vapi calls this when a call ends, triggering a follow-up email.
     """
+    body = await request.body()
+    
+    logger.info("POST /vapi-webhook")
+    
+    # Only end-of-call reports do any work; skip parsing everything else.
+    if b'"end-of-call-report"' not in body:
+        return {"success": True, "message": "Ignored"}
+    
     try:
-        payload = await request.json()
-    except:
+        payload = orjson.loads(body)
+    except orjson.JSONDecodeError:
         return {"success": False, "message": "Invalid JSON"}
     
-    print(f"POST /vapi-webhook")
+    _log_payload("/vapi-webhook", payload)
     
     message_data = payload.get("message", {})
     msg_type = message_data.get("type") or payload.get("type")
     
     if msg_type != "end-of-call-report":
-        return {"success": True, "message": f"Ignored: {msg_type}"}
-    
-    user_email = None
+        logger.debug("Ignoring webhook type: %s", msg_type)
+        return {"success": True, "message": "Ignored"}
     
-    for source in [
-        message_data.get("customer", {}),
-        payload.get("customer", {}),
-        message_data.get("call", {}).get("customer", {}),
-    ]:
-        if source and source.get("email"):
-            user_email = source["email"]
-            break
+    user_email = next(
+        (
+            source["email"]
+            for source in (
+                message_data.get("customer"),
+                payload.get("customer"),
+                message_data.get("call", {}).get("customer"),
+            )
+            if source and source.get("email")
+        ),
+        None,
+    )
     
     if not user_email:
         transcript = message_data.get("transcript") or payload.get("transcript", "")
         user_email = extract_email_from_text(transcript)
     
     if not user_email:
-        user_email = extract_email_from_text(json.dumps(payload))
+        user_email = _find_email_in_obj(payload)
     
     if not user_email:
-        print("No email found in payload")
+        logger.warning("No email found in payload")
         return {"success": False, "message": "No email found"}
     
-    print(f"Found email: {user_email}")
+    logger.info("Found email: %s", user_email)
     
-    subject = f"Your Next Steps — {COMPANY_NAME}"
+    if not _smtp_configured():
+        return {"success": False, "message": "Failed to send email"}
     
-    html_content = load_template("followup_email.html").format(
-        company_name=COMPANY_NAME
-    )
-    
-    if send_email(user_email, subject, html_content):
-        return {"success": True, "message": f"Follow-up sent to {user_email}"}
-    return {"success": False, "message": "Failed to send email"}
+    background.add_task(send_email, user_email, _FOLLOWUP_SUBJECT, _FOLLOWUP_MIMETEXT)
+    return {"success": True, "message": f"Follow-up queued for {user_email}"}
+
+
+_HEALTH_RESPONSE = JSONResponse({"status": "ok"})
 
 
 @app.get("/health")
 async def health():
     """Health check endpoint."""
-    return {"status": "ok"}
+    return _HEALTH_RESPONSE
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    if DEBUG:
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    else:
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=8000,
+            loop="auto",
+            http="auto",
+            workers=int(os.getenv("UVICORN_WORKERS", "4")),
+            reload=False,
+        )